@@ -1,3 +1,5 @@
+import os
+import glob
 import random
 from multiprocessing import Pool
 from collections import UserList, defaultdict
@@ -229,6 +231,28 @@ def get_mol(smiles_or_mol):
     return smiles_or_mol
 
 
+def read_lbann_weights(path):
+    '''
+    Loads LBANN weights text file as numpy array, using the binary
+    .npy copy made by convert_lbann_weights if it is not older than
+    the text file
+    '''
+    npy_path = os.path.splitext(path)[0] + '.npy'
+    if os.path.exists(npy_path) and \
+            os.path.getmtime(npy_path) >= os.path.getmtime(path):
+        return np.load(npy_path)
+    return np.loadtxt(path)
+
+
+def convert_lbann_weights(weights_dir):
+    '''
+    Saves a binary .npy copy next to every LBANN weights text file
+    in weights_dir, so that read_lbann_weights skips text parsing
+    '''
+    for path in glob.glob(os.path.join(weights_dir, '*-Weights.txt')):
+        np.save(os.path.splitext(path)[0] + '.npy', np.loadtxt(path))
+
+
 class StringDataset:
     def __init__(self, vocab, data):
         """
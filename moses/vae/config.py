@@ -7,6 +7,10 @@ def get_parser(parser=None):
 
     # Model
     model_arg = parser.add_argument_group('Model')
+    model_arg.add_argument('--d_emb',
+                           type=int, default=None,
+                           help='Embedding dimensionality, '
+                                'vocabulary size by default')
     model_arg.add_argument('--q_cell',
                            type=str, default='gru', choices=['gru'],
                            help='Encoder rnn cell type')
@@ -40,6 +44,14 @@ def get_parser(parser=None):
     model_arg.add_argument('--freeze_embeddings',
                            default=False, action='store_true',
                            help='If to freeze embeddings while training')
+    model_arg.add_argument('--compile',
+                           default=False, action='store_true',
+                           help='If to compile encoder/decoder '
+                                'with torch.compile')
+    model_arg.add_argument('--inference_bf16',
+                           default=False, action='store_true',
+                           help='If to reconstruct and encode SMILES '
+                                'in bfloat16 on CUDA')
 
     # Train
     train_arg = parser.add_argument_group('Train')
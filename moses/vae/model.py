@@ -1,12 +1,96 @@
+import os
+import csv
+import contextlib
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
-import glob
 import pandas as pd
+from tqdm import tqdm
+
+from moses.utils import read_lbann_weights
+
+
+@torch.jit.script
+def _reparam_kl(mu, logvar):
+    """Reparameterization trick and kl term, TorchScript fuses the
+    pointwise ops
+
+    :param mu: (n_batch, d_z) of floats, mean of q(z|x)
+    :param logvar: (n_batch, d_z) of floats, log variance of q(z|x)
+    :return: (n_batch, d_z) of floats, sample of latent vector z
+    :return: float, kl term component of loss
+    """
+    eps = torch.randn_like(mu)
+    std = torch.exp(0.5 * logvar)
+    z = mu + std * eps
+
+    kl_loss = 0.5 * (std * std + mu * mu - 1.0 - logvar).sum(1).mean()
+
+    return z, kl_loss
+
+
+class _SampleStep(nn.Module):
+    """One step of the `VAE.sample` generating cycle over the VAE decoder
+    layers. All the state tensors are updated in place and keep their
+    shapes, and nothing syncs with the host, so the step can be captured
+    into a CUDA graph or compiled with TorchScript"""
+
+    def __init__(self, x_emb, decoder_rnn, decoder_fc, pad, eos):
+        super().__init__()
+        self.x_emb = x_emb
+        self.decoder_rnn = decoder_rnn
+        self.decoder_fc = decoder_fc
+        self.pad = pad
+        self.eos = eos
+
+    def forward(self, w, h, z_0, x, eos_mask, end_pads, i, temp: float):
+        """Generates the next token of every sequence
+
+        :param w: (n_batch,) of longs, previous tokens
+        :param h: (n_layers, n_batch, d_d_h) of floats, decoder hidden state
+        :param z_0: (n_batch, 1, d_z) of floats, latent vector z
+        :param x: (n_batch, max_len) of longs, generated sequences
+        :param eos_mask: (n_batch,) of bools, if sequence is already ended
+        :param end_pads: (n_batch,) of longs, lengths of sequences
+        :param i: () of long, index of the generated token, incremented
+        :param temp: temperature of softmax, greedy decoding if temp <= 0
+        """
+        x_emb = self.x_emb(w).unsqueeze(1)
+        x_input = torch.cat([x_emb, z_0], dim=-1)
+
+        o, h_new = self.decoder_rnn(x_input, h)
+        y = self.decoder_fc(o.squeeze(1))
+        if temp <= 0:
+            # Greedy decoding, softmax doesn't change the argmax
+            w_new = y.argmax(dim=-1)
+        else:
+            # One multinomial draw as a race of exponential clocks:
+            # torch.multinomial checks its input on the host, which
+            # breaks CUDA graph capture
+            y = F.softmax(y / temp, dim=-1)
+            w_new = (y / torch.empty_like(y).exponential_(1.0)).argmax(dim=-1)
+
+        not_eos = eos_mask.logical_not()
+        i_col = i.view(1, 1).expand(x.size(0), 1)
+        w_pad = w_new.masked_fill(eos_mask, self.pad)
+        x.scatter_(1, i_col, w_pad.unsqueeze(1))
+        i_eos_mask = not_eos & (w_new == self.eos)
+        end_pads.copy_(torch.where(i_eos_mask, i + 1, end_pads))
+        eos_mask.logical_or_(i_eos_mask)
+        w.copy_(w_new)
+        h.copy_(h_new)
+        i.add_(1)
 
 
 class VAE(nn.Module):
+    # Padded lengths are rounded up to a multiple of it for torch.compile
+    COMPILE_BUCKET = 16
+    # Max number of `sample` CUDA graphs kept at once
+    SAMPLE_GRAPHS_MAX = 8
+
     def __init__(self, vocab, config):
         super().__init__()
         print("loading VAE")
@@ -15,9 +99,18 @@ class VAE(nn.Module):
         for ss in ("bos", "eos", "unk", "pad"):
             setattr(self, ss, getattr(vocab, ss))
 
+        # ASCII code -> token id, for vectorized tokenization
+        self._char_lut = np.full(256, self.unk, dtype=np.int64)
+        for c, i in vocab.c2i.items():
+            if len(c) == 1 and ord(c) < 128:
+                self._char_lut[ord(c)] = i
+
         # Word embeddings layer
         # n_vocab, d_emb = len(vocab), vocab.vectors.size(1)
-        n_vocab, d_emb = len(vocab), len(vocab)
+        # Vocab-sized embeddings unless `d_emb` is set, as in configs saved
+        # before it existed and in LBANN weights
+        n_vocab = len(vocab)
+        d_emb = getattr(config, 'd_emb', None) or n_vocab
         self.x_emb = nn.Embedding(n_vocab, d_emb, self.pad)
         # self.x_emb.weight.data.copy_(vocab.vectors)
         if config.freeze_embeddings:
@@ -62,10 +155,39 @@ class VAE(nn.Module):
         )
         self.vae = nn.ModuleList([self.x_emb, self.encoder, self.decoder])
 
+        # Captured `sample` decoding steps, keyed by
+        # (n_batch, max_len, temp, training); every graph keeps its own state
+        # buffers on the device, so at most SAMPLE_GRAPHS_MAX are kept
+        self._sample_graphs = {}
+        # `sample` generating steps, eager and TorchScript ones
+        self._sample_steps = {}
+
+        # Compiled encoder/decoder parts, keyed by function name
+        self.use_compile = getattr(config, 'compile', False)
+        self.inference_bf16 = getattr(config, 'inference_bf16', False)
+        self._compiled_fns = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        # Graphs hold raw pointers to the parameters, which `fn` may move
+        self._sample_graphs.clear()
+        self._sample_steps.clear()
+        return super()._apply(fn, *args, **kwargs)
+
     @property
     def device(self):
         return next(self.parameters()).device
 
+    def _autocast(self):
+        """bfloat16 autocast for `reconstruct` and `encode_smiles` if
+        `inference_bf16` is set and the CUDA device supports it, the decoder
+        is memory-bound and argmax doesn't need fp32"""
+        if self.inference_bf16 and self.device.type == 'cuda' and \
+                hasattr(torch, 'autocast') and \
+                torch.cuda.is_bf16_supported():
+            return torch.autocast('cuda', dtype=torch.bfloat16)
+        # No-op context, contextlib.nullcontext needs Python 3.7
+        return contextlib.suppress()
+
     def string2tensor(self, string, device="model"):
         ids = self.vocabulary.string2ids(string, add_bos=True, add_eos=True)
         tensor = torch.tensor(
@@ -75,114 +197,237 @@ class VAE(nn.Module):
 
         return tensor
 
+    def strings2tensors(self, strings, device="model"):
+        """Vectorized `string2tensor` over a list of strings, ASCII
+        strings are tokenized with a lookup table instead of per char
+
+        :param strings: list of strings
+        :param device: device of the tensors, model device by default
+        :return: list of tensors of longs, ids with bos and eos
+        """
+        device = self.device if device == 'model' else device
+
+        tensors = []
+        for string in strings:
+            try:
+                codes = np.frombuffer(string.encode('ascii'), dtype=np.uint8)
+            except UnicodeEncodeError:
+                tensors.append(self.string2tensor(string, device=device))
+                continue
+
+            ids = np.empty(len(codes) + 2, dtype=np.int64)
+            ids[0], ids[-1] = self.bos, self.eos
+            ids[1:-1] = self._char_lut[codes]
+            tensors.append(torch.from_numpy(ids).to(device))
+
+        return tensors
+
     def tensor2string(self, tensor):
         ids = tensor.tolist()
         string = self.vocabulary.ids2string(ids, rem_bos=True, rem_eos=True)
 
         return string
 
-    def forward(self, x):
+    def forward(self, x, lengths):
         """Do the VAE forward step
 
-        :param x: list of tensors of longs, input sentence x
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param lengths: (n_batch,) of longs, lengths of x
         :return: float, kl term component of loss
         :return: float, recon component of loss
         """
 
         # Encoder: x -> z, kl_loss
-        z, kl_loss = self.forward_encoder(x)
+        z, kl_loss = self.forward_encoder(x, lengths)
 
         # Decoder: x, z -> recon_loss
-        pred = self.forward_decoder(x, z)
-        recon_loss = self.compute_loss(x, pred)
+        pred = self.forward_decoder(x, lengths, z)
+        recon_loss = self.compute_loss(x, lengths, pred)
 
         return kl_loss, recon_loss
 
-    def forward_encoder(self, x):
+    def forward_encoder(self, x, lengths):
         """Encoder step, emulating z ~ E(x) = q_E(z|x)
 
-        :param x: list of tensors of longs, input sentence x
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param lengths: (n_batch,) of longs, lengths of x
         :return: (n_batch, d_z) of floats, sample of latent vector z
         :return: float, kl term component of loss
         """
 
-        x = [self.x_emb(i_x) for i_x in x]
-        x = nn.utils.rnn.pack_sequence(x)
+        x = self.x_emb(x)
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(),
+                                              batch_first=True,
+                                              enforce_sorted=False)
 
         _, h = self.encoder_rnn(x, None)
 
         h = h[-(1 + int(self.encoder_rnn.bidirectional)) :]
         h = torch.cat(h.split(1), dim=-1).squeeze(0)
 
-        mu, logvar = self.q_mu(h), self.q_logvar(h)
-        eps = torch.randn_like(mu)
-        z = mu + (logvar / 2).exp() * eps
+        return self._call_compiled(self._encode_core, h)
 
-        kl_loss = 0.5 * (logvar.exp() + mu ** 2 - 1 - logvar).sum(1).mean()
+    def _encode_core(self, h):
+        """Static shape part of the encoder step: latent distribution,
+        reparameterization and kl term
 
-        return z, kl_loss
+        :param h: (n_batch, q_d_last) of floats, last encoder hidden state
+        :return: (n_batch, d_z) of floats, sample of latent vector z
+        :return: float, kl term component of loss
+        """
 
-    def forward_decoder(self, x, z):
+        mu, logvar = self.q_mu(h), self.q_logvar(h)
+
+        return _reparam_kl(mu, logvar)
+
+    def forward_decoder(self, x, lengths, z):
         """Decoder step, emulating x ~ G(z)
 
-        :param x: list of tensors of longs, input sentence x
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param lengths: (n_batch,) of longs, lengths of x
         :param z: (n_batch, d_z) of floats, latent vector z
-        :return: float, recon component of loss
+        :return: PackedSequence of (sum of lengths - 1, n_vocab) of floats,
+            predictions of the next token for every non-pad position of x
         """
 
-        lengths = [len(i_x) for i_x in x]
+        # Last token is never an input: nothing is predicted after it
+        x, lengths = x[:, :-1], lengths.cpu() - 1
+
+        # No-op for batches already bucketed by `VAETrainer` collate
+        x = self.pad_to_bucket(x)
+
+        x_input, h_0 = self._call_compiled(self._decode_core, x, z)
+        x_input = nn.utils.rnn.pack_padded_sequence(x_input, lengths,
+                                                    batch_first=True,
+                                                    enforce_sorted=False)
+
+        output, _ = self.decoder_rnn(x_input, h_0)
+
+        # Projecting only real tokens, pads never reach `decoder_fc`
+        y = self.decoder_fc(output.data)
+        return nn.utils.rnn.PackedSequence(y, output.batch_sizes,
+                                           output.sorted_indices,
+                                           output.unsorted_indices)
+
+    def _decode_core(self, x, z):
+        """Static shape part of the decoder step: rnn inputs and initial
+        hidden state
+
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param z: (n_batch, d_z) of floats, latent vector z
+        :return: (n_batch, len, d_emb + d_z) of floats, decoder rnn input
+        :return: (n_layers, n_batch, d_d_h) of floats, initial hidden state
+        """
 
-        x = nn.utils.rnn.pad_sequence(x, batch_first=True, padding_value=self.pad)
         x_emb = self.x_emb(x)
 
-        z_0 = z.unsqueeze(1).repeat(1, x_emb.size(1), 1)
+        z_0 = z.unsqueeze(1).expand(-1, x_emb.size(1), -1)
         x_input = torch.cat([x_emb, z_0], dim=-1)
-        x_input = nn.utils.rnn.pack_padded_sequence(x_input, lengths, batch_first=True)
 
-        h_0 = self.decoder_lat(z)
-        h_0 = h_0.unsqueeze(0).repeat(self.decoder_rnn.num_layers, 1, 1)
+        h_0 = self.decoder_lat(z).unsqueeze(0)
+        if self.decoder_rnn.num_layers > 1:
+            h_0 = h_0.repeat(self.decoder_rnn.num_layers, 1, 1)
 
-        output, _ = self.decoder_rnn(x_input, h_0)
+        return x_input, h_0
 
-        output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
-        y = self.decoder_fc(output)
-        return y
+    def pad_to_bucket(self, x, offset=0):
+        """Pads x up to the bucket length if `use_compile` is set, so that
+        compiled functions see a bounded number of lengths
 
-    def compute_loss(x, y):
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param offset: length of x minus `offset` becomes a bucket multiple
+        :return: (n_batch, bucket len) of longs, x with extra pads
+        """
 
-        recon_loss = F.cross_entropy(
-            y[:, :-1].contiguous().view(-1, y.size(-1)),
-            x[:, 1:].contiguous().view(-1),
-            ignore_index=self.pad,
-        )
+        if not self.use_compile:
+            return x
+
+        n_pad = -(x.size(1) - offset) % self.COMPILE_BUCKET
+        return F.pad(x, (0, n_pad), value=self.pad)
+
+    def _call_compiled(self, fn, *args):
+        """Calls `fn` compiled with torch.compile if `use_compile` is set,
+        or `fn` itself otherwise. Every function is compiled once, with
+        dynamic batch dimension, so that only bucket lengths recompile"""
+
+        if not self.use_compile:
+            return fn(*args)
+
+        import torch._dynamo
+
+        if fn.__name__ not in self._compiled_fns:
+            self._compiled_fns[fn.__name__] = torch.compile(
+                fn, backend='inductor', mode='reduce-overhead'
+            )
+
+        for arg in args:
+            # Sizes 0 and 1 are always specialized by dynamo
+            if arg.size(0) > 1:
+                torch._dynamo.mark_dynamic(arg, 0)
+
+        return self._compiled_fns[fn.__name__](*args)
+
+    def compute_loss(self, x, lengths, y):
+        """Reconstruction loss of the decoder predictions
+
+        :param x: (n_batch, len) of longs, padded input sentence x
+        :param lengths: (n_batch,) of longs, lengths of x
+        :param y: PackedSequence of floats, output of `forward_decoder`
+        :return: float, recon component of loss
+        """
+
+        # Targets are x shifted by one, packed in the same layout as `y`:
+        # sorted with the permutation of `y` itself, not sorted again
+        target, lengths = x[:, 1:], lengths.cpu() - 1
+        if y.sorted_indices is not None:
+            target = target.index_select(0, y.sorted_indices)
+            lengths = lengths.index_select(0, y.sorted_indices.cpu())
+        target = nn.utils.rnn.pack_padded_sequence(target, lengths,
+                                                   batch_first=True).data
+        recon_loss = F.cross_entropy(y.data, target)
 
         return recon_loss
 
+    def logits2smiles(self, logits, lengths=None):
+        """Converts decoder outputs to strings, stopping at eos or pad
+
+        :param logits: (n_batch, len, n_vocab) of floats, decoder outputs
+        :param lengths: (n_batch,) of longs, lengths of outputs or None,
+            padded positions past them are never converted
+        :return: list of strings, most probable sequences
+        """
+
+        ids = logits.argmax(dim=2)  # (B,L)
+        stop = (ids == self.eos) | (ids == self.pad)
+        stop_lengths = stop.long().cumsum(1).eq(0).sum(1)
+        if lengths is None:
+            lengths = stop_lengths
+        else:
+            lengths = torch.min(stop_lengths, lengths.to(ids.device))
+
+        ids, lengths = ids.tolist(), lengths.tolist()
+        return [self.vocabulary.ids2string(i_ids[:length])
+                for i_ids, length in zip(ids, lengths)]
+
     def reconstruct(self, tqdm_data, save_path):
         all_samples = []
-        for i, input_batch in enumerate(tqdm_data):
-            input_batch = tuple(data.to(self.device) for data in input_batch)
-            with torch.no_grad():
-                z, _ = self.forward_encoder(input_batch)
-                output = self.forward_decoder(input_batch, z)
+        for i, (x, lengths) in enumerate(tqdm_data):
+            x = x.to(self.device)
+            with torch.no_grad(), self._autocast():
+                z, _ = self.forward_encoder(x, lengths)
+                output = self.forward_decoder(x, lengths, z)
+                output, _ = nn.utils.rnn.pad_packed_sequence(
+                    output, batch_first=True
+                )
                 output = F.log_softmax(output, dim=2)  # (B,L,V)
 
-            smiles = []
-            for s in range(output.size(0)):  # for each sample in batch
-                sample = []
-                for c in range(output.size(1)):  # char in sequence
-                    v = torch.argmax(output[s][c]).item()
-                    if v == self.eos or v == self.pad:
-                        break
-                    else:
-                        sample.append(v)
-                pred_sm = self.tensor2string(torch.Tensor(sample))
-                smiles.append(pred_sm)
-
+            smiles = self.logits2smiles(output, lengths - 1)
             all_samples.extend(smiles)
 
-        all_samples = pd.DataFrame(all_samples, columns=["SMILES"])
-        all_samples.to_csv(save_path, index=False)
+        with open(save_path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["SMILES"])
+            writer.writerows([smiles] for smiles in all_samples)
         return
 
     def sample_z_prior(self, n_batch):
@@ -203,211 +448,239 @@ class VAE(nn.Module):
         :param n_batch: number of sentences to generate
         :param max_len: max len of samples
         :param z: (n_batch, d_z) of floats, latent vector z or None
-        :param temp: temperature of softmax
+        :param temp: temperature of softmax, greedy decoding if temp <= 0
         :return: list of tensors of strings, samples sequence x
         """
         with torch.no_grad():
             if z is None:
                 z = self.sample_z_prior(n_batch)
             z = z.to(self.device)
-            z_0 = z.unsqueeze(1)
-
-            # Initial values
-            h = self.decoder_lat(z)
-            h = h.unsqueeze(0).repeat(self.decoder_rnn.num_layers, 1, 1)
-            w = torch.tensor(self.bos, device=self.device).repeat(n_batch)
-            x = torch.tensor([self.pad], device=self.device).repeat(n_batch,
-                                                                    max_len)
-            x[:, 0] = self.bos
 
-            end_pads = torch.tensor([max_len], device=self.device).repeat(n_batch)
-            eos_mask = torch.zeros(n_batch, dtype=torch.bool, device=self.device)
+            # Generating cycle, there are no steps at all if max_len <= 1
+            use_graph = (self.device.type == 'cuda' and
+                         hasattr(torch.cuda, 'CUDAGraph') and max_len > 1)
+            if use_graph:
+                try:
+                    graph, state = self._get_sample_graph(n_batch, max_len,
+                                                          temp)
+                except RuntimeError:
+                    # Capture failed, replaying the step without a graph
+                    use_graph = False
+            if not use_graph:
+                # No graphs here, TorchScript removes the Python overhead
+                step = self._get_sample_step(script=True)
+                state = self._sample_state(n_batch, max_len)
 
-            # Generating cycle
-            for i in range(1, max_len):
-                x_emb = self.x_emb(w).unsqueeze(1)
-                x_input = torch.cat([x_emb, z_0], dim=-1)
-
-                o, h = self.decoder_rnn(x_input, h)
-                y = self.decoder_fc(o.squeeze(1))
-                y = F.softmax(y / temp, dim=-1)
-
-                w = torch.multinomial(y, 1)[:, 0]
-                x[~eos_mask, i] = w[~eos_mask]
-                i_eos_mask = ~eos_mask & (w == self.eos)
-                end_pads[i_eos_mask] = i + 1
-                eos_mask = eos_mask | i_eos_mask
-
-            # Converting `x` to list of tensors
-            new_x = []
-            for i in range(x.size(0)):
-                new_x.append(x[i, :end_pads[i]])
+            # Initial values
+            state['h'].copy_(self.decoder_lat(z).unsqueeze(0))
+            state['z_0'].copy_(z.unsqueeze(1))
+            state['w'].fill_(self.bos)
+            state['x'].fill_(self.pad)
+            state['x'][:, 0] = self.bos
+            state['end_pads'].fill_(max_len)
+            state['eos_mask'].zero_()
+            state['i'].fill_(1)
+
+            for _ in range(1, max_len):
+                if use_graph:
+                    graph.replay()
+                else:
+                    step(temp=float(temp), **state)
+
+            # Converting `x` to strings, one transfer of the whole batch;
+            # bos is always first, eos is last only if it was generated
+            x, end_pads = state['x'].tolist(), state['end_pads'].tolist()
+            return [self.vocabulary.ids2string(i_x[1:length], rem_bos=False)
+                    for i_x, length in zip(x, end_pads)]
+
+    def _sample_state(self, n_batch, max_len):
+        """Preallocates the state tensors of `_SampleStep`
+
+        :return: dict of tensors, `_SampleStep` arguments except temp
+        """
+        device = self.device
+        return {
+            'w': torch.full((n_batch,), self.bos,
+                            dtype=torch.long, device=device),
+            'h': torch.zeros(self.decoder_rnn.num_layers, n_batch,
+                             self.decoder_rnn.hidden_size, device=device),
+            'z_0': torch.zeros(n_batch, 1, self.q_mu.out_features,
+                               device=device),
+            'x': torch.full((n_batch, max_len), self.pad,
+                            dtype=torch.long, device=device),
+            'eos_mask': torch.zeros(n_batch, dtype=torch.bool,
+                                    device=device),
+            'end_pads': torch.full((n_batch,), max_len,
+                                   dtype=torch.long, device=device),
+            'i': torch.ones((), dtype=torch.long, device=device)
+        }
+
+    def _get_sample_step(self, script=False):
+        """Returns `_SampleStep` over the decoder layers, compiled with
+        TorchScript if `script` is set, created once
+
+        :param script: if to return TorchScript step
+        :return: _SampleStep, or its ScriptModule
+        """
+        if script not in self._sample_steps:
+            step = _SampleStep(self.x_emb, self.decoder_rnn, self.decoder_fc,
+                               self.pad, self.eos)
+            self._sample_steps[script] = (torch.jit.script(step)
+                                          if script else step)
 
+        # Steps aren't submodules, so they don't follow train()/eval()
+        return self._sample_steps[script].train(self.training)
 
-            return [self.tensor2string(i_x) for i_x in new_x]
+    def _get_sample_graph(self, n_batch, max_len, temp):
+        """Captures `_SampleStep` into a CUDA graph over static state
+        tensors, or returns the one captured before
 
-    def load_lbann_weights(self, weights_dir, epoch_count=-1):
+        :return: torch.cuda.CUDAGraph, graph of one generating step
+        :return: dict of tensors, state the graph reads and writes
+        """
+        key = (n_batch, max_len, temp, self.training)
+        if key not in self._sample_graphs:
+            if len(self._sample_graphs) >= self.SAMPLE_GRAPHS_MAX:
+                # Dropping the oldest graph together with its state
+                del self._sample_graphs[next(iter(self._sample_graphs))]
+
+            step = self._get_sample_step()
+            state = self._sample_state(n_batch, max_len)
+
+            # Warmup on a side stream, as required before capturing; every
+            # step writes at the first index, which is valid for max_len > 1
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    state['i'].fill_(1)
+                    step(temp=temp, **state)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            state['i'].fill_(1)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                step(temp=temp, **state)
+
+            self._sample_graphs[key] = (graph, state)
+
+        return self._sample_graphs[key]
+
+    def load_lbann_weights(self, weights_dir, epoch_count=-1, n_workers=8):
         print("Loading LBANN Weights ")
         if epoch_count < 0:
             epoch_count = "*"
 
-        with torch.no_grad():
-            emb_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*-emb_matrix-Weights.txt"
-                )[0]
-            )
-            self.x_emb.weight.data.copy_(torch.from_numpy(np.transpose(emb_weights)))
-
-            # q_logvar_weights = np.loadtxt(glob.glob(weights_dir+"*.epoch."+str(epoch_count)+"*-molvae_module1_encoder_qlogvar_matrix-Weights.txt")[0])
-
-            q_logvar_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*qlogvar_matrix-Weights.txt"
-                )[0]
-            )
-            self.q_logvar.weight.data.copy_(torch.from_numpy(q_logvar_weights))
-            #q_logvar_bias = np.loadtxt(glob.glob(weights_dir+ "*.epoch."+ str(epoch_count)+ "*-molvae_module1_encoder_qlogvar_bias-Weights.txt")[0])
-            q_logvar_bias = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*qlogvar_bias-Weights.txt"
-                )[0]
-            )
-            self.q_logvar.bias.data.copy_(torch.from_numpy(q_logvar_bias))
-            
-            """
-            q_mu_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*-molvae_module1_encoder_qmu_matrix-Weights.txt"
-                )[0]
-            )
-            """
-
-
-            q_mu_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*qmu_matrix-Weights.txt"
-                )[0]
-            )
-
+        # One directory scan, every file below is looked up in `names`
+        directory, prefix = os.path.split(weights_dir)
+        names = sorted(os.listdir(directory or "."))
+
+        def weights_path(pattern):
+            name = fnmatch.filter(
+                names, prefix + "*.epoch." + str(epoch_count) + pattern
+            )[0]
+            return os.path.join(directory, name)
+
+        # Every file is found before any read starts, so that a missing one
+        # fails right away
+        loads = [
+            (self.x_emb.weight.data.t(),
+             weights_path("*-emb_matrix-Weights.txt")),
+            (self.q_logvar.weight.data,
+             weights_path("*qlogvar_matrix-Weights.txt")),
+            (self.q_logvar.bias.data,
+             weights_path("*qlogvar_bias-Weights.txt")),
+            (self.q_mu.weight.data,
+             weights_path("*qmu_matrix-Weights.txt")),
+            (self.q_mu.bias.data,
+             weights_path("*-molvae_module1_encoder_qmu_bias-Weights.txt")),
+            (self.decoder_lat.weight.data,
+             weights_path("*-molvae_module1_decoder_lat_matrix-Weights.txt")),
+            (self.decoder_lat.bias.data,
+             weights_path("*-molvae_module1_decoder_lat_bias-Weights.txt")),
+        ]
+
+        # Load RNN weights/biases
+        param_idx = ["_ih_matrix", "_hh_matrix", "_ih_bias", "_hh_bias"]
+        for layer in range(self.encoder_rnn.num_layers):
+            for idx, val in enumerate(param_idx):
+                loads.append((
+                    self.encoder_rnn.all_weights[layer][idx].data,
+                    weights_path("*-molvae_module1_encoder_rnn*" + val
+                                 + "-Weights.txt")
+                ))
+
+        for layer in range(self.decoder_rnn.num_layers):
+            for idx, val in enumerate(param_idx):
+                loads.append((
+                    self.decoder_rnn.all_weights[layer][idx].data,
+                    weights_path("*-molvae_module1_decoder_rnn*" + str(layer)
+                                 + val + "-Weights.txt")
+                ))
+
+        # Load Linear layer weights/biases
+        loads.extend([
+            (self.decoder_fc.weight.data,
+             weights_path("*_decoder_fc_matrix-Weights.txt")),
+            (self.decoder_fc.bias.data,
+             weights_path("*_decoder_fc_bias-Weights.txt")),
+        ])
+
+        # Files are read in parallel, parameters are filled in order below
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(read_lbann_weights, path)
+                       for _, path in loads]
+            with torch.no_grad():
+                for (param, path), weights in zip(loads, futures):
+                    weights = torch.from_numpy(weights.result())
+                    if weights.shape != param.shape:
+                        raise ValueError(
+                            "LBANN weights {} of shape {} don't match model "
+                            "parameter of shape {}, check model config "
+                            "(e.g. d_emb)".format(path, tuple(weights.shape),
+                                                  tuple(param.shape))
+                        )
+                    param.copy_(weights)
+
+        print("DONE loading LBANN weights ")
+
+    def encode_smiles(self, smiles, n_batch=256):
+        """Encodes and decodes back SMILES, batching strings of similar length
+
+        :param smiles: list of strings, SMILES to encode
+        :param n_batch: number of SMILES in one batch
+        :return: list of (1, len - 1, n_vocab) of floats, decoder log-probs
+            of the tokens after bos for every SMILES (len counts bos and
+            eos), in the order of `smiles`
+        :return: list of strings, `smiles`
+        """
 
-            self.q_mu.weight.data.copy_(torch.from_numpy(q_mu_weights))
-            q_mu_bias = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*-molvae_module1_encoder_qmu_bias-Weights.txt"
-                )[0]
-            )
-            self.q_mu.bias.data.copy_(torch.from_numpy(q_mu_bias))
-
-            decoder_lat_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*-molvae_module1_decoder_lat_matrix-Weights.txt"
-                )[0]
-            )
-            self.decoder_lat.weight.data.copy_(torch.from_numpy(decoder_lat_weights))
-            decoder_lat_bias = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*-molvae_module1_decoder_lat_bias-Weights.txt"
-                )[0]
+        tensor_list = self.strings2tensors(smiles, device='cpu')
+        order = sorted(range(len(tensor_list)),
+                       key=lambda i: len(tensor_list[i]), reverse=True)
+
+        latent_list = [None] * len(tensor_list)
+        for start in tqdm(range(0, len(order), n_batch),
+                          desc="encoding smiles"):
+            batch_idx = order[start:start + n_batch]
+            lengths = torch.tensor([len(tensor_list[i]) for i in batch_idx],
+                                   dtype=torch.long)
+            x = nn.utils.rnn.pad_sequence(
+                [tensor_list[i] for i in batch_idx],
+                batch_first=True, padding_value=self.pad
             )
-            self.decoder_lat.bias.data.copy_(torch.from_numpy(decoder_lat_bias))
-
-            # Load RNN weights/biases
-            param_idx = ["_ih_matrix", "_hh_matrix", "_ih_bias", "_hh_bias"]
-            for l in range(self.encoder_rnn.num_layers):
-                for idx, val in enumerate(param_idx):
-                    param_tensor = np.loadtxt(
-                        glob.glob(
-                            weights_dir
-                            + "*.epoch."
-                            + str(epoch_count)
-                            + "*-molvae_module1_encoder_rnn*"
-                            + val
-                            + "-Weights.txt"
-                        )[0]
-                    )
-                    self.encoder_rnn.all_weights[l][idx].copy_(
-                        torch.from_numpy(param_tensor)
-                    )
-
-            for l in range(self.decoder_rnn.num_layers):
-                for idx, val in enumerate(param_idx):
-                    param_tensor = np.loadtxt(
-                        glob.glob(
-                            weights_dir
-                            + "*.epoch."
-                            + str(epoch_count)
-                            + "*-molvae_module1_decoder_rnn*"
-                            + str(l)
-                            + val
-                            + "-Weights.txt"
-                        )[0]
-                    )
-                    self.decoder_rnn.all_weights[l][idx].copy_(
-                        torch.from_numpy(param_tensor)
-                    )
-
-            # Load Linear layer weights/biases
-            decoder_fc_weights = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*_decoder_fc_matrix-Weights.txt"
-                )[0]
-            )
-            self.decoder_fc.weight.data.copy_(torch.from_numpy(decoder_fc_weights))
-            decoder_fc_bias = np.loadtxt(
-                glob.glob(
-                    weights_dir
-                    + "*.epoch."
-                    + str(epoch_count)
-                    + "*_decoder_fc_bias-Weights.txt"
-                )[0]
-            )
-            self.decoder_fc.bias.data.copy_(torch.from_numpy(decoder_fc_bias))
-
-            print("DONE loading LBANN weights ")
-
-    def encode_smiles(self, smiles):
-        from tqdm import tqdm
-
-        tensor_list = []
-        for smile in tqdm(smiles, desc="converting smiles to tensors"):
-            tensor_list.append(self.string2tensor(smile).view(1, -1))
-
-        latent_list = []
-        for i, input_batch in enumerate(tensor_list):
-            input_batch = tuple(data.to(self.device) for data in input_batch)
-            with torch.no_grad():
-                z, _ = self.forward_encoder(input_batch)
-                output = self.forward_decoder(input_batch, z)
+            x = x.to(self.device, non_blocking=True)
+            with torch.no_grad(), self._autocast():
+                z, _ = self.forward_encoder(x, lengths)
+                output = self.forward_decoder(x, lengths, z)
+                output, _ = nn.utils.rnn.pad_packed_sequence(
+                    output, batch_first=True
+                )
                 output = F.log_softmax(output, dim=2)  # (B,L,V)
-                latent_list.append(output)
+
+            for i, i_output, length in zip(batch_idx, output,
+                                           lengths.tolist()):
+                latent_list[i] = i_output[:length - 1].unsqueeze(0)
 
         return latent_list, smiles
 
@@ -415,18 +688,7 @@ class VAE(nn.Module):
         all_samples = []
         for latent in latent_array:
             latent = torch.from_numpy(latent)
-            smiles = []
-            for s in range(latent.shape[0]):  # for each sample in batch
-                sample = []
-                for c in range(latent.shape[1]):  # char in sequence
-                    v = torch.argmax(latent[s][c]).item()
-                    if v == self.eos or v == self.pad:
-                        break
-                    else:
-                        sample.append(v)
-                pred_sm = self.tensor2string(torch.Tensor(sample))
-                smiles.append(pred_sm)
-
+            smiles = self.logits2smiles(latent)
             all_samples.extend(smiles)
 
         all_samples = pd.DataFrame(all_samples, columns=["SMILES"])
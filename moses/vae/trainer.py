@@ -3,6 +3,7 @@ import torch.optim as optim
 from tqdm.auto import tqdm
 
 from torch.nn.utils import clip_grad_norm_
+from torch.nn.utils.rnn import pad_sequence
 
 from moses.interfaces import MosesTrainer
 from moses.utils import OneHotVocab, Logger, CircularBuffer
@@ -21,10 +22,15 @@ class VAETrainer(MosesTrainer):
 
         def collate(data):
             data.sort(key=len, reverse=True)
-            tensors = [model.string2tensor(string, device=device)
-                       for string in data]
+            tensors = model.strings2tensors(data, device='cpu')
 
-            return tensors
+            x = pad_sequence(tensors, batch_first=True,
+                             padding_value=model.vocabulary.pad)
+            # Decoder drops the last token, its inputs get a bucket length
+            x = model.pad_to_bucket(x, offset=1).to(device)
+            lengths = torch.tensor([len(t) for t in tensors],
+                                   dtype=torch.long)
+            return x, lengths
 
         return collate
 
@@ -37,11 +43,11 @@ class VAETrainer(MosesTrainer):
         kl_loss_values = CircularBuffer(self.config.n_last)
         recon_loss_values = CircularBuffer(self.config.n_last)
         loss_values = CircularBuffer(self.config.n_last)
-        for input_batch in tqdm_data:
-            input_batch = tuple(data.to(model.device) for data in input_batch)
+        for x, lengths in tqdm_data:
+            x = x.to(model.device)
 
             # Forward
-            kl_loss, recon_loss = model(input_batch)
+            kl_loss, recon_loss = model(x, lengths)
             loss = kl_weight * kl_loss + recon_loss
 
             # Backward
@@ -0,0 +1,18 @@
+import argparse
+
+from moses.utils import convert_lbann_weights
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Saves binary .npy copies of LBANN weights text files, '
+                    'which load_lbann_weights then reads instead')
+    parser.add_argument('--lbann_weights_dir', type=str, required=True,
+                        help='Directory with LBANN *-Weights.txt files')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    config = parser.parse_args()
+    convert_lbann_weights(config.lbann_weights_dir)
@@ -0,0 +1,189 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import (pack_padded_sequence, pad_packed_sequence,
+                                pad_sequence)
+from moses.utils import OneHotVocab
+from moses.vae import VAE, VAETrainer, vae_parser
+
+
+class test_vae(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # Mixed lengths, unsorted, with ties
+        self.data = ['CCO', 'c1ccccc1', 'CNC', 'CC(=O)Oc1ccccc1C(=O)O', 'N']
+        vocab = OneHotVocab.from_data(self.data)
+        self.config = vae_parser().parse_args(['--q_d_h', '16',
+                                               '--d_d_h', '16',
+                                               '--d_z', '8',
+                                               '--d_n_layers', '2'])
+        self.model = VAE(vocab, self.config).eval()
+
+    def padded_loss(self, x, lengths, z):
+        # Reconstruction loss as computed before packing decoder outputs
+        model = self.model
+        x_emb = model.x_emb(x)
+        z_0 = z.unsqueeze(1).repeat(1, x_emb.size(1), 1)
+        x_input = torch.cat([x_emb, z_0], dim=-1)
+        x_input = pack_padded_sequence(x_input, lengths, batch_first=True,
+                                       enforce_sorted=False)
+        h_0 = model.decoder_lat(z)
+        h_0 = h_0.unsqueeze(0).repeat(model.decoder_rnn.num_layers, 1, 1)
+        output, _ = model.decoder_rnn(x_input, h_0)
+        output, _ = pad_packed_sequence(output, batch_first=True)
+        y = model.decoder_fc(output)
+
+        return F.cross_entropy(y[:, :-1].reshape(-1, y.size(-1)),
+                               x[:, 1:].reshape(-1),
+                               ignore_index=model.pad)
+
+    def test_packed_loss(self):
+        tensors = [self.model.string2tensor(string, device='cpu')
+                   for string in self.data]
+        x = pad_sequence(tensors, batch_first=True,
+                         padding_value=self.model.pad)
+        lengths = torch.tensor([len(t) for t in tensors], dtype=torch.long)
+        z = torch.randn(len(self.data), self.config.d_z)
+        with torch.no_grad():
+            y = self.model.forward_decoder(x, lengths, z)
+            loss = self.model.compute_loss(x, lengths, y)
+            target = self.padded_loss(x, lengths, z)
+        self.assertAlmostEqual(loss.item(), target.item(), places=5)
+
+    def test_forward(self):
+        collate = VAETrainer(self.config).get_collate_fn(self.model)
+        x, lengths = collate(list(self.data))
+        kl_loss, recon_loss = self.model(x, lengths)
+        self.assertTrue(torch.isfinite(kl_loss).item())
+        self.assertTrue(torch.isfinite(recon_loss).item())
+
+    def greedy_samples(self, z, max_len):
+        # Greedy decoding token by token, stopping every row at its eos
+        model = self.model
+        h = model.decoder_lat(z).unsqueeze(0)
+        h = h.repeat(model.decoder_rnn.num_layers, 1, 1)
+        w = torch.full((z.size(0),), model.bos, dtype=torch.long)
+        ids = [[] for _ in range(z.size(0))]
+        ended = [False] * z.size(0)
+        for _ in range(1, max_len):
+            x_input = torch.cat([model.x_emb(w).unsqueeze(1), z.unsqueeze(1)],
+                                dim=-1)
+            o, h = model.decoder_rnn(x_input, h)
+            w = model.decoder_fc(o.squeeze(1)).argmax(dim=-1)
+            for row, token in enumerate(w.tolist()):
+                ended[row] = ended[row] or token == model.eos
+                if not ended[row]:
+                    ids[row].append(token)
+
+        return [model.vocabulary.ids2string(i_ids, rem_bos=False,
+                                            rem_eos=False)
+                for i_ids in ids]
+
+    def test_sample(self):
+        n_batch = 4
+        samples = self.model.sample(n_batch, max_len=20)
+        self.assertEqual(len(samples), n_batch)
+        for sample in samples:
+            self.assertNotIn(self.model.vocabulary.ss.eos, sample)
+
+    def test_short_sample(self):
+        # Fewer generating steps than the CUDA graph warmup, or none at all
+        for max_len in range(1, 4):
+            samples = self.model.sample(4, max_len=max_len)
+            self.assertEqual(len(samples), 4)
+            if max_len == 1:
+                self.assertEqual(samples, [''] * 4)
+
+    def test_greedy_sample(self):
+        z = torch.randn(4, self.config.d_z)
+        with torch.no_grad():
+            target = self.greedy_samples(z, max_len=20)
+        self.assertEqual(self.model.sample(4, max_len=20, z=z, temp=0),
+                         target)
+
+    def test_eos_sample(self):
+        # Every sequence ends at the first step, with bos and eos stripped
+        with torch.no_grad():
+            self.model.decoder_fc.bias[self.model.eos] = 1e4
+        self.assertEqual(self.model.sample(4, max_len=20), [''] * 4)
+
+    def save_lbann_weights(self, model, weights_dir):
+        # Text files named as LBANN exports them, one per parameter
+        params = [
+            ('-emb_matrix', model.x_emb.weight.t()),
+            ('-molvae_module1_encoder_qlogvar_matrix', model.q_logvar.weight),
+            ('-molvae_module1_encoder_qlogvar_bias', model.q_logvar.bias),
+            ('-molvae_module1_encoder_qmu_matrix', model.q_mu.weight),
+            ('-molvae_module1_encoder_qmu_bias', model.q_mu.bias),
+            ('-molvae_module1_decoder_lat_matrix', model.decoder_lat.weight),
+            ('-molvae_module1_decoder_lat_bias', model.decoder_lat.bias),
+            ('-molvae_module1_decoder_fc_matrix', model.decoder_fc.weight),
+            ('-molvae_module1_decoder_fc_bias', model.decoder_fc.bias),
+        ]
+        param_idx = ['_ih_matrix', '_hh_matrix', '_ih_bias', '_hh_bias']
+        for idx, val in enumerate(param_idx):
+            params.append(('-molvae_module1_encoder_rnn' + val,
+                           model.encoder_rnn.all_weights[0][idx]))
+            for layer in range(model.decoder_rnn.num_layers):
+                params.append((
+                    '-molvae_module1_decoder_rnn' + str(layer) + val,
+                    model.decoder_rnn.all_weights[layer][idx]
+                ))
+
+        for suffix, param in params:
+            path = os.path.join(weights_dir,
+                                'model0.epoch.2' + suffix + '-Weights.txt')
+            np.savetxt(path, param.detach().numpy())
+
+    def test_load_lbann_weights(self):
+        torch.manual_seed(1)
+        source = VAE(self.model.vocabulary, self.config)
+        with tempfile.TemporaryDirectory() as weights_dir:
+            self.save_lbann_weights(source, weights_dir)
+            self.model.load_lbann_weights(os.path.join(weights_dir, 'model'))
+
+        source_params = dict(source.named_parameters())
+        for name, param in self.model.named_parameters():
+            self.assertTrue(torch.equal(param, source_params[name]), name)
+
+    def test_load_lbann_weights_shape(self):
+        config = vae_parser().parse_args(['--q_d_h', '16',
+                                          '--d_d_h', '16',
+                                          '--d_z', '8',
+                                          '--d_n_layers', '2',
+                                          '--d_emb', '4'])
+        source = VAE(self.model.vocabulary, config)
+        with tempfile.TemporaryDirectory() as weights_dir:
+            self.save_lbann_weights(source, weights_dir)
+            with self.assertRaises(ValueError):
+                self.model.load_lbann_weights(
+                    os.path.join(weights_dir, 'model')
+                )
+
+    def test_encode_smiles(self):
+        # Nearly zero variance of q(z|x), so that z doesn't depend on noise
+        with torch.no_grad():
+            self.model.q_logvar.weight.zero_()
+            self.model.q_logvar.bias.fill_(-100)
+        outputs, smiles = self.model.encode_smiles(self.data, n_batch=2)
+        self.assertEqual(smiles, self.data)
+        for string, output in zip(self.data, outputs):
+            target, _ = self.model.encode_smiles([string], n_batch=1)
+            self.assertEqual(output.shape, (1, len(string) + 1,
+                                            len(self.model.vocabulary)))
+            self.assertTrue(torch.allclose(output, target[0], atol=1e-5))
+
+    def test_strings2tensors(self):
+        # ASCII, non-ASCII and unknown character strings
+        strings = ['CC(=O)O', 'CC\u00e9N', 'CCXN', '']
+        tensors = self.model.strings2tensors(strings, device='cpu')
+        for string, tensor in zip(strings, tensors):
+            target = self.model.string2tensor(string, device='cpu')
+            self.assertTrue(torch.equal(tensor, target))
+
+
+if __name__ == "__main__":
+    unittest.main()